@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
 # -.- coding: UTF-8 -.-
 
+import os
 import re
 import sys
+import time
 import argparse
+import numpy as np
 import pandas as pd
 import seaborn as sns
 
 from os.path import join
 from matplotlib import pyplot as plt
-from datetime import datetime
-from collections import defaultdict
-from wordcloud import WordCloud
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from wordcloud import WordCloud, STOPWORDS
+
+# read chat exports in large chunks to reduce the number of read calls
+READ_BUFFER_SIZE = 1 << 20
+# minimum time in seconds between two progress messages while parsing
+PROGRESS_INTERVAL = 0.5
 
 weekdays = [
     "Monday",
@@ -26,19 +35,19 @@ weekdays = [
 languages = {
     "en": {
         "date_content": r'^(\d\d/\d\d/\d\d\d\d, \d\d:\d\d) - (.*)$',
-        "deleted": r'^This message was deleted$',
-        "media": r'^<Media omitted>$',
+        "deleted": "This message was deleted",
+        "media": "<Media omitted>",
         "date_format": "%d/%m/%Y, %H:%M",
-        "created": r'^.* created group "(.*)"$',
-        "rename": r'^.* changed the subject from ".*" to "(.*)"$'
+        "created": r'.* created group "(?P<created>.*)"',
+        "rename": r'.* changed the subject from ".*" to "(?P<rename>.*)"'
     },
     "de": {
-        "date_content": r'^(\d\d.\d\d.\d\d, \d\d:\d\d) - (.*)$',
-        "deleted": r'^Diese Nachricht wurde gelöscht.$',
-        "media": r'^<Medien ausgeschlossen>$',
+        "date_content": r'^(\d\d\.\d\d\.\d\d, \d\d:\d\d) - (.*)$',
+        "deleted": "Diese Nachricht wurde gelöscht.",
+        "media": "<Medien ausgeschlossen>",
         "date_format": "%d.%m.%y, %H:%M",
-        "created": r'^.* hat die Gruppe „(.*)“ erstellt.$',
-        "rename": r'^.* hat den Betreff von „.*“ zu „(.*)“ geändert.$'
+        "created": r'.* hat die Gruppe „(?P<created>.*)“ erstellt.',
+        "rename": r'.* hat den Betreff von „.*“ zu „(?P<rename>.*)“ geändert.'
     }
 }
 
@@ -47,20 +56,30 @@ def truncate(string, length):
     return string[:length] + (string[length-3:] and "...")
 
 
+def parse_chat(filename, language):
+    # module level, so it can be run in worker processes
+    p = Parser(language)
+    p.parse_file_by_name(filename)
+    return p
+
+
 class Parser:
     def __init__(self, language, aliases=None, multipart=True, cw="common_words/de.txt"):
         if type(language) == str:
             # treat parameter as language code
             language = languages[language]
         self.regex_date_content = re.compile(language['date_content'])
-        self.regex_message = re.compile(r'^(.*?): (.*)$', re.DOTALL)
-        self.regex_deleted = re.compile(language['deleted'])
-        self.regex_media = re.compile(language['media'])
-        self.regex_words = re.compile(r"[\w'-]+")
-        self.regex_created = re.compile(language['created'])
-        self.regex_rename = re.compile(language['rename'])
+        # chat messages, group creation and renaming are matched in a single pass
+        self.regex_entry = re.compile(r'^(?:(?s:(?P<author>.*?): (?P<body>.*))|%s|%s)$'
+                                      % (language['created'], language['rename']))
+        # same tokenization as WordCloud.process_text
+        self.regex_words = re.compile(r"\w[\w']*")
         self.regex_emoticon = re.compile(r':\)\)?|\(:|:/|:\||:\(|\):|\^\^|[xX][dD]|:[pP]|:b|:D|D:\b')
         self.date_format = language['date_format']
+        # bodies of deleted messages and omitted media are fixed placeholder texts
+        self.ignored_bodies = frozenset((language['deleted'], language['media']))
+        # the character between day and month, e.g. "/" for "%d/%m/%Y"
+        self.date_separator = language['date_format'][2]
 
         self.emoticon_counter = defaultdict(int)
 
@@ -69,90 +88,124 @@ class Parser:
         self.chat_name = None
 
         self.aliases = aliases if aliases else {}
+        # maps author names as they appear in the chat to their normalized names
+        self._author_cache = {}
         self.multipart = multipart
-        self.msgs = []
+        self.raw_msgs = []
+        self.members = []
+        self.msgs = {}
 
-        self.all_words = ""
+        self.word_counts = Counter()
 
         with open(cw) as f:
-            self.common_words = [line.strip() for line in f]
-
-    def handle_text_message(self, date, author, body):
-        # multipart: if two messages are sent in less than 3 minutes by the same author,
-        # they are combined into one message
-        # initiator: if a question (containing "?") is posted after 24 hours of silence
-
-        multipart = False
-        initiator = True
+            # the word cloud is generated from frequencies, so WordCloud's own stopwords are applied here
+            self.common_words = frozenset(line.strip().lower() for line in f) | STOPWORDS
 
-        if self.multipart and len(self.msgs) > 0:
-            diff = (date - self.msgs[-1][1]).total_seconds()
-
-            if diff < 60 * 60 * 24 or "?" not in body:
-                initiator = False
-
-            if self.msgs[-1][0] == author and diff < 60 * 3:
-                multipart = True
-
-        for word in self.regex_words.finditer(body):
-            word = word.group(0).lower()
-            if word not in self.common_words:
-                self.all_words += " " + word
-        self.all_words += ". "
+    def handle_text_message(self, date_str, author, body):
+        words = (word[:-2] if word.endswith("'s") else word for word in self.regex_words.findall(body.lower()))
+        self.word_counts.update(word for word in words if word not in self.common_words and not word.isdigit())
 
         for em in self.regex_emoticon.finditer(body):
             self.emoticon_counter[em.group(0)] += 1
 
-        if multipart:
-            self.msgs[-1][2] += len(body)
-            self.msgs[-1][3] += 1
-        else:
-            self.msgs.append([author, date, len(body), 1, initiator])
+        self.raw_msgs.append((author, date_str, len(body), "?" in body))
 
-    def handle_entry(self):
-        if self.date_buffer is None:
-            print("No entry was found. Make sure you used the right language code.", file=sys.stderr)
-            sys.exit(1)
+    def combine_messages(self):
+        # multipart: if two messages are sent in less than 3 minutes by the same author,
+        # they are combined into one message
+        # initiator: if a question (containing "?") is posted after 24 hours of silence
 
+        n = len(self.raw_msgs)
+        authors = np.empty(n, dtype=object)
+        date_strs = [None] * n
+        body_lens = np.empty(n, dtype=np.int32)
+        questions = np.empty(n, dtype=bool)
+        for i, (author, date_str, body_len, question) in enumerate(self.raw_msgs):
+            authors[i] = author
+            date_strs[i] = date_str
+            body_lens[i] = body_len
+            questions[i] = question
+
+        # dates are kept as strings while parsing and converted in one go,
+        # consecutive messages often share the same minute so the cache pays off.
+        # Invalid dates are therefore only reported once the whole file has been read
         try:
-            date = datetime.strptime(self.date_buffer, self.date_format)
+            dates = pd.to_datetime(date_strs, format=self.date_format, cache=True)
         except ValueError as e:
             print("Error while parsing date. Make sure you used the right language code.", file=sys.stderr)
             print(e)
             sys.exit(1)
 
-        message = self.regex_message.match(self.content_buffer)
-        if message:
-            # chat message
-            author = message.group(1)
-            body = message.group(2)
-
-            if author in self.aliases:
-                author = self.aliases[author]
-            if " " in author and "+" not in author:
-                author = author.split(" ")[0]
-
-            if self.regex_deleted.match(body):
-                pass
-            elif self.regex_media.match(body):
-                pass
-            else:
-                self.handle_text_message(date, author, body)
+        dates = dates.to_numpy().astype('datetime64[s]')
+        diffs = np.diff(dates).astype('int64')
+        initiator = np.ones(n, dtype=bool)
+        initiator[1:] = (diffs >= 60 * 60 * 24) & questions[1:]
+        new_msg = np.ones(n, dtype=bool)
+        if self.multipart:
+            new_msg[1:] = (diffs >= 60 * 3) | (authors[1:] != authors[:-1])
+
+        starts = np.flatnonzero(new_msg)
+        self.append_messages(authors[starts].tolist(), {
+            "date": dates[starts],
+            "body_len": np.add.reduceat(body_lens, starts),
+            "parts": np.diff(np.append(starts, n)).astype(np.int32),
+            "initiator": initiator[starts],
+        })
+        # the raw messages are not needed anymore once combined
+        self.raw_msgs = []
+
+    def append_messages(self, members, msgs):
+        self.members += members
+        if self.msgs:
+            self.msgs = {column: np.concatenate((values, msgs[column]))
+                         for column, values in self.msgs.items()}
         else:
-            created = self.regex_created.match(self.content_buffer)
-            if created:
-                self.chat_name = created.group(1)
-                print("Created:", self.chat_name)
+            self.msgs = msgs
 
-            rename = self.regex_rename.match(self.content_buffer)
-            if rename:
-                self.chat_name = rename.group(1)
-                print("Renamed:", self.chat_name)
+    def merge(self, other):
+        # combines the results of another parser, e.g. of a different chat file
+        self.append_messages(other.members, other.msgs)
+        self.word_counts.update(other.word_counts)
+        for em, count in other.emoticon_counter.items():
+            self.emoticon_counter[em] += count
+        if self.chat_name != other.chat_name:
+            self.chat_name = None
 
-            pass
+    def handle_entry(self):
+        if self.date_buffer is None:
+            print("No entry was found. Make sure you used the right language code.", file=sys.stderr)
+            sys.exit(1)
+
+        entry = self.regex_entry.match(self.content_buffer)
+        if entry is None:
+            return
+
+        if entry.group('author') is not None:
+            # chat message
+            raw_author = entry.group('author')
+            body = entry.group('body')
+
+            author = self._author_cache.get(raw_author)
+            if author is None:
+                author = self.aliases.get(raw_author, raw_author)
+                if " " in author and "+" not in author:
+                    author = author.split(" ")[0]
+                self._author_cache[raw_author] = author
+
+            if body not in self.ignored_bodies:
+                self.handle_text_message(self.date_buffer, author, body)
+        elif entry.group('created') is not None:
+            self.chat_name = entry.group('created')
+            print("Created:", self.chat_name)
+        elif entry.group('rename') is not None:
+            self.chat_name = entry.group('rename')
+            print("Renamed:", self.chat_name)
 
     def parse_line(self, line):
-        match = self.regex_date_content.match(line)
+        # every entry starts with a date of fixed shape, so lines not starting with
+        # two digits and the date separator are continuations
+        match = (line[:1].isdigit() and line[2:3] == self.date_separator
+                 and self.regex_date_content.match(line))
 
         if match:
             if self.date_buffer:
@@ -162,26 +215,35 @@ class Parser:
             self.content_buffer = match.group(2)
         else:
             # line is continuation
-            self.content_buffer += "\n" + line
+            self.content_buffer += "\n" + line.rstrip("\r\n")
 
     def parse_file(self, fp):
         print("Parsing file...")
+        parse_line = self.parse_line
         i = 0
+        last_progress = time.monotonic()
         for line in fp:
-            self.parse_line(line)
+            parse_line(line)
             i += 1
-            if i % 500 == 0:
+            # report progress at most twice per second
+            if i % 500 == 0 and time.monotonic() - last_progress > PROGRESS_INTERVAL:
                 print(i, "lines parsed")
+                last_progress = time.monotonic()
         self.handle_entry()
-        print("Done parsing.", i, "lines,", len(self.msgs), "messages")
+        self.combine_messages()
+        print("Done parsing.", i, "lines,", len(self.members), "messages")
 
     def parse_file_by_name(self, filename):
-        with open(filename) as fp:
+        with open(filename, buffering=READ_BUFFER_SIZE, encoding="UTF-8") as fp:
+            if hasattr(os, "posix_fadvise"):
+                # large exports are read front to back, let the kernel read ahead accordingly
+                os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
             self.parse_file(fp)
 
     def visualize(self, show_plots=True, save_dir="out"):
-        msgs = pd.DataFrame(self.msgs, columns=["member", "date", "body_len", "parts", "initiator"])
-        msgs_per_member = msgs.groupby("member").agg({"date": "count", "body_len": "mean", "initiator": "sum"})
+        msgs = pd.DataFrame({"member": pd.Categorical(self.members), **self.msgs})
+        msgs_per_member = msgs.groupby("member", observed=True, sort=False).agg(
+            {"date": "count", "body_len": "mean", "initiator": "sum"})
         emoticons = pd.Series(self.emoticon_counter).sort_values(ascending=False).head(10)
 
         prefix = ""
@@ -194,14 +256,13 @@ class Parser:
             if show_plots:
                 plt.show()
 
-        count_per_member = msgs_per_member['date'].sort_values(ascending=False).head(20)
-        len_per_member = msgs_per_member['body_len'].sort_values(ascending=False).head(20)
-        init_per_member = msgs_per_member['initiator'].sort_values(ascending=False).head(20)
-        heat_data = msgs['date'].groupby([msgs['date'].dt.weekday, msgs['date'].dt.hour]).count()
-        heat_data.rename("msg_count", inplace=True)
-        heat_data.index.rename(["day", "hour"], inplace=True)
-        heat_pivot = pd.pivot_table(heat_data.to_frame(), values="msg_count", index=['day'], columns=['hour'])
-        heat_pivot.index = heat_pivot.index.map(lambda x: weekdays[x])
+        count_per_member = msgs_per_member['date'].nlargest(20)
+        len_per_member = msgs_per_member['body_len'].nlargest(20)
+        init_per_member = msgs_per_member['initiator'].nlargest(20)
+        heat_index = msgs['date'].dt.weekday.to_numpy() * 24 + msgs['date'].dt.hour.to_numpy()
+        heat_counts = np.bincount(heat_index, minlength=7 * 24).reshape(7, 24)
+        heat_pivot = pd.DataFrame(heat_counts, index=pd.Index(weekdays, name="day"),
+                                  columns=pd.RangeIndex(24, name="hour"))
 
         count_plot = count_per_member.plot(kind="bar", color="teal", legend=None,
                                            title=prefix + "Most active chat members")
@@ -224,11 +285,18 @@ class Parser:
         show_and_save("emoticon")
 
         plt.figure(figsize=(16, 5))
-        sns.heatmap(heat_pivot, cmap="Greens", cbar=False, annot=True, fmt=".0f")
+        sns.heatmap(heat_pivot, mask=heat_pivot == 0, cmap="Greens", cbar=False, annot=True, fmt=".0f")
         plt.title(prefix + "Chat Activity")
         show_and_save("activity")
 
-        cloud = WordCloud().generate(self.all_words)
+        # merge plurals into their singular like WordCloud.process_text does
+        word_counts = Counter(self.word_counts)
+        for word in list(word_counts):
+            singular = word[:-1]
+            if word.endswith("s") and not word.endswith("ss") and singular in word_counts:
+                word_counts[singular] += word_counts.pop(word)
+
+        cloud = WordCloud().generate_from_frequencies(word_counts)
         plt.imshow(cloud, interpolation="bilinear")
         plt.title(prefix + "Common Words")
         plt.axis("off")
@@ -244,12 +312,34 @@ if __name__ == '__main__':
     argp.add_argument("--lang", default="en", choices=languages.keys(),
                       help="Phone language used while exporting the chat. Determines date format etc. "
                            "This is independent of the language used in chat")
-    argp.add_argument("chatfile", type=argparse.FileType(mode="r", encoding="UTF-8"),
-                      help="Exported WhatsApp Chat file (usually .txt)")
+    argp.add_argument("chatfile", nargs="+",
+                      help="Exported WhatsApp Chat file (usually .txt), or - to read from stdin. "
+                           "Multiple files are parsed in parallel and analyzed together")
     argp.add_argument("--save", metavar="DIR", default=None, help="Directory in which plots get saved")
     argp.add_argument("--no-plots", action="store_true", help="Don't show plots")
     args = argp.parse_args()
 
-    p = Parser(args.lang)
-    p.parse_file(args.chatfile)
+    for chatfile in args.chatfile:
+        if chatfile == "-":
+            if len(args.chatfile) > 1:
+                argp.error("reading from stdin ('-') is only supported for a single chat file")
+            continue
+        # fail early with a proper message, like argparse.FileType did
+        try:
+            open(chatfile, encoding="UTF-8").close()
+        except OSError as e:
+            argp.error("can't open '%s': %s" % (chatfile, e))
+
+    if args.chatfile == ["-"]:
+        p = Parser(args.lang)
+        p.parse_file(sys.stdin)
+    elif len(args.chatfile) == 1:
+        p = parse_chat(args.chatfile[0], args.lang)
+    else:
+        with ProcessPoolExecutor() as executor:
+            parsers = list(executor.map(parse_chat, args.chatfile, repeat(args.lang)))
+        p = parsers[0]
+        for other in parsers[1:]:
+            p.merge(other)
+
     p.visualize(show_plots=not args.no_plots, save_dir=args.save)